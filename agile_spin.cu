@@ -0,0 +1,563 @@
+/*
+ * CUDA kernels for ECMA-376 Agile password verification, for the two hash algorithms Office
+ * uses: SHA-512 (the default since Office 2013) and SHA-256.
+ *
+ * Each thread takes one password's initial hash H0 = H(salt + password) and computes
+ * Hn = H(iterator + Hn-1) for spin_count rounds. The message (the 4-byte iterator and the
+ * previous hash) always fits in a single padded block, so the hash state and the message
+ * schedule stay in registers for the whole loop. The thread then finishes the check the way
+ * _check_agile_hash does in main.py: it derives the two AES keys from the final hash and the
+ * block keys, decrypts the verifier and its hash, and writes a single match flag. Global
+ * memory is only touched to load H0 and the verifier and to store the flag.
+ *
+ * Loaded from main.py with cupy.RawKernel, which compiles it with NVRTC, so this file does
+ * not include any headers.
+ */
+typedef unsigned char uint8_t;
+typedef unsigned int uint32_t;
+typedef unsigned long long uint64_t;
+
+__constant__ uint32_t K256[64] = {
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2
+};
+
+__constant__ uint64_t K[80] = {
+    0x428a2f98d728ae22ULL, 0x7137449123ef65cdULL, 0xb5c0fbcfec4d3b2fULL, 0xe9b5dba58189dbbcULL,
+    0x3956c25bf348b538ULL, 0x59f111f1b605d019ULL, 0x923f82a4af194f9bULL, 0xab1c5ed5da6d8118ULL,
+    0xd807aa98a3030242ULL, 0x12835b0145706fbeULL, 0x243185be4ee4b28cULL, 0x550c7dc3d5ffb4e2ULL,
+    0x72be5d74f27b896fULL, 0x80deb1fe3b1696b1ULL, 0x9bdc06a725c71235ULL, 0xc19bf174cf692694ULL,
+    0xe49b69c19ef14ad2ULL, 0xefbe4786384f25e3ULL, 0x0fc19dc68b8cd5b5ULL, 0x240ca1cc77ac9c65ULL,
+    0x2de92c6f592b0275ULL, 0x4a7484aa6ea6e483ULL, 0x5cb0a9dcbd41fbd4ULL, 0x76f988da831153b5ULL,
+    0x983e5152ee66dfabULL, 0xa831c66d2db43210ULL, 0xb00327c898fb213fULL, 0xbf597fc7beef0ee4ULL,
+    0xc6e00bf33da88fc2ULL, 0xd5a79147930aa725ULL, 0x06ca6351e003826fULL, 0x142929670a0e6e70ULL,
+    0x27b70a8546d22ffcULL, 0x2e1b21385c26c926ULL, 0x4d2c6dfc5ac42aedULL, 0x53380d139d95b3dfULL,
+    0x650a73548baf63deULL, 0x766a0abb3c77b2a8ULL, 0x81c2c92e47edaee6ULL, 0x92722c851482353bULL,
+    0xa2bfe8a14cf10364ULL, 0xa81a664bbc423001ULL, 0xc24b8b70d0f89791ULL, 0xc76c51a30654be30ULL,
+    0xd192e819d6ef5218ULL, 0xd69906245565a910ULL, 0xf40e35855771202aULL, 0x106aa07032bbd1b8ULL,
+    0x19a4c116b8d2d0c8ULL, 0x1e376c085141ab53ULL, 0x2748774cdf8eeb99ULL, 0x34b0bcb5e19b48a8ULL,
+    0x391c0cb3c5c95a63ULL, 0x4ed8aa4ae3418acbULL, 0x5b9cca4f7763e373ULL, 0x682e6ff3d6b2b8a3ULL,
+    0x748f82ee5defb2fcULL, 0x78a5636f43172f60ULL, 0x84c87814a1f0ab72ULL, 0x8cc702081a6439ecULL,
+    0x90befffa23631e28ULL, 0xa4506cebde82bde9ULL, 0xbef9a3f7b2c67915ULL, 0xc67178f2e372532bULL,
+    0xca273eceea26619cULL, 0xd186b8c721c0c207ULL, 0xeada7dd6cde0eb1eULL, 0xf57d4f7fee6ed178ULL,
+    0x06f067aa72176fbaULL, 0x0a637dc5a2c898a6ULL, 0x113f9804bef90daeULL, 0x1b710b35131c471bULL,
+    0x28db77f523047d84ULL, 0x32caab7b40c72493ULL, 0x3c9ebe0a15c9bebcULL, 0x431d67c49c100d4cULL,
+    0x4cc5d4becb3e42b6ULL, 0x597f299cfc657e2aULL, 0x5fcb6fab3ad6faecULL, 0x6c44198c4a475817ULL
+};
+
+/* The AES S-box, used by the key expansion */
+__constant__ uint8_t SBOX[256] = {
+    0x63, 0x7c, 0x77, 0x7b, 0xf2, 0x6b, 0x6f, 0xc5, 0x30, 0x01, 0x67, 0x2b, 0xfe, 0xd7, 0xab, 0x76,
+    0xca, 0x82, 0xc9, 0x7d, 0xfa, 0x59, 0x47, 0xf0, 0xad, 0xd4, 0xa2, 0xaf, 0x9c, 0xa4, 0x72, 0xc0,
+    0xb7, 0xfd, 0x93, 0x26, 0x36, 0x3f, 0xf7, 0xcc, 0x34, 0xa5, 0xe5, 0xf1, 0x71, 0xd8, 0x31, 0x15,
+    0x04, 0xc7, 0x23, 0xc3, 0x18, 0x96, 0x05, 0x9a, 0x07, 0x12, 0x80, 0xe2, 0xeb, 0x27, 0xb2, 0x75,
+    0x09, 0x83, 0x2c, 0x1a, 0x1b, 0x6e, 0x5a, 0xa0, 0x52, 0x3b, 0xd6, 0xb3, 0x29, 0xe3, 0x2f, 0x84,
+    0x53, 0xd1, 0x00, 0xed, 0x20, 0xfc, 0xb1, 0x5b, 0x6a, 0xcb, 0xbe, 0x39, 0x4a, 0x4c, 0x58, 0xcf,
+    0xd0, 0xef, 0xaa, 0xfb, 0x43, 0x4d, 0x33, 0x85, 0x45, 0xf9, 0x02, 0x7f, 0x50, 0x3c, 0x9f, 0xa8,
+    0x51, 0xa3, 0x40, 0x8f, 0x92, 0x9d, 0x38, 0xf5, 0xbc, 0xb6, 0xda, 0x21, 0x10, 0xff, 0xf3, 0xd2,
+    0xcd, 0x0c, 0x13, 0xec, 0x5f, 0x97, 0x44, 0x17, 0xc4, 0xa7, 0x7e, 0x3d, 0x64, 0x5d, 0x19, 0x73,
+    0x60, 0x81, 0x4f, 0xdc, 0x22, 0x2a, 0x90, 0x88, 0x46, 0xee, 0xb8, 0x14, 0xde, 0x5e, 0x0b, 0xdb,
+    0xe0, 0x32, 0x3a, 0x0a, 0x49, 0x06, 0x24, 0x5c, 0xc2, 0xd3, 0xac, 0x62, 0x91, 0x95, 0xe4, 0x79,
+    0xe7, 0xc8, 0x37, 0x6d, 0x8d, 0xd5, 0x4e, 0xa9, 0x6c, 0x56, 0xf4, 0xea, 0x65, 0x7a, 0xae, 0x08,
+    0xba, 0x78, 0x25, 0x2e, 0x1c, 0xa6, 0xb4, 0xc6, 0xe8, 0xdd, 0x74, 0x1f, 0x4b, 0xbd, 0x8b, 0x8a,
+    0x70, 0x3e, 0xb5, 0x66, 0x48, 0x03, 0xf6, 0x0e, 0x61, 0x35, 0x57, 0xb9, 0x86, 0xc1, 0x1d, 0x9e,
+    0xe1, 0xf8, 0x98, 0x11, 0x69, 0xd9, 0x8e, 0x94, 0x9b, 0x1e, 0x87, 0xe9, 0xce, 0x55, 0x28, 0xdf,
+    0x8c, 0xa1, 0x89, 0x0d, 0xbf, 0xe6, 0x42, 0x68, 0x41, 0x99, 0x2d, 0x0f, 0xb0, 0x54, 0xbb, 0x16
+};
+
+/* The inverse AES S-box, used to decrypt */
+__constant__ uint8_t INV_SBOX[256] = {
+    0x52, 0x09, 0x6a, 0xd5, 0x30, 0x36, 0xa5, 0x38, 0xbf, 0x40, 0xa3, 0x9e, 0x81, 0xf3, 0xd7, 0xfb,
+    0x7c, 0xe3, 0x39, 0x82, 0x9b, 0x2f, 0xff, 0x87, 0x34, 0x8e, 0x43, 0x44, 0xc4, 0xde, 0xe9, 0xcb,
+    0x54, 0x7b, 0x94, 0x32, 0xa6, 0xc2, 0x23, 0x3d, 0xee, 0x4c, 0x95, 0x0b, 0x42, 0xfa, 0xc3, 0x4e,
+    0x08, 0x2e, 0xa1, 0x66, 0x28, 0xd9, 0x24, 0xb2, 0x76, 0x5b, 0xa2, 0x49, 0x6d, 0x8b, 0xd1, 0x25,
+    0x72, 0xf8, 0xf6, 0x64, 0x86, 0x68, 0x98, 0x16, 0xd4, 0xa4, 0x5c, 0xcc, 0x5d, 0x65, 0xb6, 0x92,
+    0x6c, 0x70, 0x48, 0x50, 0xfd, 0xed, 0xb9, 0xda, 0x5e, 0x15, 0x46, 0x57, 0xa7, 0x8d, 0x9d, 0x84,
+    0x90, 0xd8, 0xab, 0x00, 0x8c, 0xbc, 0xd3, 0x0a, 0xf7, 0xe4, 0x58, 0x05, 0xb8, 0xb3, 0x45, 0x06,
+    0xd0, 0x2c, 0x1e, 0x8f, 0xca, 0x3f, 0x0f, 0x02, 0xc1, 0xaf, 0xbd, 0x03, 0x01, 0x13, 0x8a, 0x6b,
+    0x3a, 0x91, 0x11, 0x41, 0x4f, 0x67, 0xdc, 0xea, 0x97, 0xf2, 0xcf, 0xce, 0xf0, 0xb4, 0xe6, 0x73,
+    0x96, 0xac, 0x74, 0x22, 0xe7, 0xad, 0x35, 0x85, 0xe2, 0xf9, 0x37, 0xe8, 0x1c, 0x75, 0xdf, 0x6e,
+    0x47, 0xf1, 0x1a, 0x71, 0x1d, 0x29, 0xc5, 0x89, 0x6f, 0xb7, 0x62, 0x0e, 0xaa, 0x18, 0xbe, 0x1b,
+    0xfc, 0x56, 0x3e, 0x4b, 0xc6, 0xd2, 0x79, 0x20, 0x9a, 0xdb, 0xc0, 0xfe, 0x78, 0xcd, 0x5a, 0xf4,
+    0x1f, 0xdd, 0xa8, 0x33, 0x88, 0x07, 0xc7, 0x31, 0xb1, 0x12, 0x10, 0x59, 0x27, 0x80, 0xec, 0x5f,
+    0x60, 0x51, 0x7f, 0xa9, 0x19, 0xb5, 0x4a, 0x0d, 0x2d, 0xe5, 0x7a, 0x9f, 0x93, 0xc9, 0x9c, 0xef,
+    0xa0, 0xe0, 0x3b, 0x4d, 0xae, 0x2a, 0xf5, 0xb0, 0xc8, 0xeb, 0xbb, 0x3c, 0x83, 0x53, 0x99, 0x61,
+    0x17, 0x2b, 0x04, 0x7e, 0xba, 0x77, 0xd6, 0x26, 0xe1, 0x69, 0x14, 0x63, 0x55, 0x21, 0x0c, 0x7d
+};
+
+/* The block keys of the verifier input and the verifier hash, as big-endian words */
+#define BLOCK_KEY_VERIFIER_HASH_INPUT 0xfea7d2763b4b9e79ULL
+#define BLOCK_KEY_VERIFIER_HASH_VALUE 0xd7aa0f6d3061344eULL
+
+/* The largest expanded AES key: 15 round keys of 16 bytes for AES-256 */
+#define AES_MAX_ROUND_KEYS 240
+
+#define ROTR(x, n) (((x) >> (n)) | ((x) << (64 - (n))))
+#define ROTR32(x, n) (((x) >> (n)) | ((x) << (32 - (n))))
+
+/* Computes the SHA-256 digest of a single, already padded, 64-byte block */
+__device__ __forceinline__ void sha256_block(uint32_t w[16], uint32_t state[8])
+{
+    uint32_t a = 0x6a09e667;
+    uint32_t b = 0xbb67ae85;
+    uint32_t c = 0x3c6ef372;
+    uint32_t d = 0xa54ff53a;
+    uint32_t e = 0x510e527f;
+    uint32_t f = 0x9b05688c;
+    uint32_t g = 0x1f83d9ab;
+    uint32_t h = 0x5be0cd19;
+
+#pragma unroll
+    for (int t = 0; t < 64; t++) {
+        uint32_t wt;
+        if (t < 16) {
+            wt = w[t];
+        } else {
+            /* The message schedule is kept as a rolling window of 16 words */
+            uint32_t w15 = w[(t - 15) & 15];
+            uint32_t w2 = w[(t - 2) & 15];
+            uint32_t s0 = ROTR32(w15, 7) ^ ROTR32(w15, 18) ^ (w15 >> 3);
+            uint32_t s1 = ROTR32(w2, 17) ^ ROTR32(w2, 19) ^ (w2 >> 10);
+            wt = w[t & 15] + s0 + w[(t - 7) & 15] + s1;
+            w[t & 15] = wt;
+        }
+
+        uint32_t t1 = h + (ROTR32(e, 6) ^ ROTR32(e, 11) ^ ROTR32(e, 25)) + ((e & f) ^ (~e & g))
+            + K256[t] + wt;
+        uint32_t t2 = (ROTR32(a, 2) ^ ROTR32(a, 13) ^ ROTR32(a, 22)) + ((a & b) ^ (a & c) ^ (b & c));
+        h = g;
+        g = f;
+        f = e;
+        e = d + t1;
+        d = c;
+        c = b;
+        b = a;
+        a = t1 + t2;
+    }
+
+    state[0] = 0x6a09e667 + a;
+    state[1] = 0xbb67ae85 + b;
+    state[2] = 0x3c6ef372 + c;
+    state[3] = 0xa54ff53a + d;
+    state[4] = 0x510e527f + e;
+    state[5] = 0x9b05688c + f;
+    state[6] = 0x1f83d9ab + g;
+    state[7] = 0x5be0cd19 + h;
+}
+
+/* Computes the SHA-512 digest of a single, already padded, 128-byte block */
+__device__ __forceinline__ void sha512_block(uint64_t w[16], uint64_t state[8])
+{
+    uint64_t a = 0x6a09e667f3bcc908ULL;
+    uint64_t b = 0xbb67ae8584caa73bULL;
+    uint64_t c = 0x3c6ef372fe94f82bULL;
+    uint64_t d = 0xa54ff53a5f1d36f1ULL;
+    uint64_t e = 0x510e527fade682d1ULL;
+    uint64_t f = 0x9b05688c2b3e6c1fULL;
+    uint64_t g = 0x1f83d9abfb41bd6bULL;
+    uint64_t h = 0x5be0cd19137e2179ULL;
+
+#pragma unroll
+    for (int t = 0; t < 80; t++) {
+        uint64_t wt;
+        if (t < 16) {
+            wt = w[t];
+        } else {
+            /* The message schedule is kept as a rolling window of 16 words */
+            uint64_t w15 = w[(t - 15) & 15];
+            uint64_t w2 = w[(t - 2) & 15];
+            uint64_t s0 = ROTR(w15, 1) ^ ROTR(w15, 8) ^ (w15 >> 7);
+            uint64_t s1 = ROTR(w2, 19) ^ ROTR(w2, 61) ^ (w2 >> 6);
+            wt = w[t & 15] + s0 + w[(t - 7) & 15] + s1;
+            w[t & 15] = wt;
+        }
+
+        uint64_t t1 = h + (ROTR(e, 14) ^ ROTR(e, 18) ^ ROTR(e, 41)) + ((e & f) ^ (~e & g))
+            + K[t] + wt;
+        uint64_t t2 = (ROTR(a, 28) ^ ROTR(a, 34) ^ ROTR(a, 39)) + ((a & b) ^ (a & c) ^ (b & c));
+        h = g;
+        g = f;
+        f = e;
+        e = d + t1;
+        d = c;
+        c = b;
+        b = a;
+        a = t1 + t2;
+    }
+
+    state[0] = 0x6a09e667f3bcc908ULL + a;
+    state[1] = 0xbb67ae8584caa73bULL + b;
+    state[2] = 0x3c6ef372fe94f82bULL + c;
+    state[3] = 0xa54ff53a5f1d36f1ULL + d;
+    state[4] = 0x510e527fade682d1ULL + e;
+    state[5] = 0x9b05688c2b3e6c1fULL + f;
+    state[6] = 0x1f83d9abfb41bd6bULL + g;
+    state[7] = 0x5be0cd19137e2179ULL + h;
+}
+
+/* Multiplies by x in GF(2^8) */
+__device__ __forceinline__ uint8_t xtime(uint8_t b)
+{
+    return (uint8_t)((b << 1) ^ ((b & 0x80) ? 0x1b : 0));
+}
+
+/* Multiplies two elements of GF(2^8), for the fixed coefficients of InvMixColumns */
+__device__ __forceinline__ uint8_t gmul(uint8_t a, uint8_t b)
+{
+    uint8_t p = 0;
+    while (b) {
+        if (b & 1) {
+            p ^= a;
+        }
+        a = xtime(a);
+        b >>= 1;
+    }
+    return p;
+}
+
+/* Expands a 16, 24 or 32-byte AES key into its round keys and returns the number of rounds */
+__device__ int aes_expand_key(const uint8_t *key, uint32_t key_bytes, uint8_t *round_keys)
+{
+    int nk = key_bytes / 4;
+    int rounds = nk + 6;
+    uint8_t rcon = 1;
+
+    for (int i = 0; i < nk * 4; i++) {
+        round_keys[i] = key[i];
+    }
+    for (int i = nk; i < 4 * (rounds + 1); i++) {
+        uint8_t t[4];
+        for (int j = 0; j < 4; j++) {
+            t[j] = round_keys[(i - 1) * 4 + j];
+        }
+        if (i % nk == 0) {
+            /* RotWord, SubWord and the round constant */
+            uint8_t first = t[0];
+            t[0] = SBOX[t[1]] ^ rcon;
+            t[1] = SBOX[t[2]];
+            t[2] = SBOX[t[3]];
+            t[3] = SBOX[first];
+            rcon = xtime(rcon);
+        } else if (nk > 6 && i % nk == 4) {
+            for (int j = 0; j < 4; j++) {
+                t[j] = SBOX[t[j]];
+            }
+        }
+        for (int j = 0; j < 4; j++) {
+            round_keys[i * 4 + j] = round_keys[(i - nk) * 4 + j] ^ t[j];
+        }
+    }
+    return rounds;
+}
+
+/* Decrypts a single 16-byte block with AES. Only a handful of blocks are decrypted per
+   password, next to spin_count hashes, so this is the plain byte-wise inverse cipher. */
+__device__ void aes_decrypt_block(
+    const uint8_t *round_keys, int rounds, const uint8_t *in, uint8_t out[16])
+{
+    uint8_t s[16];
+    for (int i = 0; i < 16; i++) {
+        s[i] = in[i] ^ round_keys[rounds * 16 + i];
+    }
+
+    for (int n = rounds - 1; ; n--) {
+        /* InvShiftRows moves row r right by r columns; InvSubBytes is done on the way */
+        uint8_t t[16];
+        for (int c = 0; c < 4; c++) {
+            for (int r = 0; r < 4; r++) {
+                t[r + 4 * ((c + r) & 3)] = INV_SBOX[s[r + 4 * c]];
+            }
+        }
+        for (int i = 0; i < 16; i++) {
+            s[i] = t[i] ^ round_keys[n * 16 + i];
+        }
+        if (n == 0) {
+            break;
+        }
+
+        /* InvMixColumns */
+        for (int c = 0; c < 4; c++) {
+            uint8_t a0 = s[4 * c];
+            uint8_t a1 = s[4 * c + 1];
+            uint8_t a2 = s[4 * c + 2];
+            uint8_t a3 = s[4 * c + 3];
+            s[4 * c] = gmul(a0, 14) ^ gmul(a1, 11) ^ gmul(a2, 13) ^ gmul(a3, 9);
+            s[4 * c + 1] = gmul(a0, 9) ^ gmul(a1, 14) ^ gmul(a2, 11) ^ gmul(a3, 13);
+            s[4 * c + 2] = gmul(a0, 13) ^ gmul(a1, 9) ^ gmul(a2, 14) ^ gmul(a3, 11);
+            s[4 * c + 3] = gmul(a0, 11) ^ gmul(a1, 13) ^ gmul(a2, 9) ^ gmul(a3, 14);
+        }
+    }
+
+    for (int i = 0; i < 16; i++) {
+        out[i] = s[i];
+    }
+}
+
+/*
+ * The verifier is laid out as the IV (16 bytes), the encrypted verifier input (16 bytes) and
+ * the encrypted verifier hash, cut to the digest size.
+ */
+#define VERIFIER_IV 0
+#define VERIFIER_INPUT 16
+#define VERIFIER_HASH 32
+
+/* Decrypts the verifier input with the first derived key, AES-CBC over a single block */
+__device__ void decrypt_verifier_input(
+    const uint8_t *key, uint32_t key_bytes, const uint8_t *verifier, uint8_t out[16])
+{
+    uint8_t round_keys[AES_MAX_ROUND_KEYS];
+    int rounds = aes_expand_key(key, key_bytes, round_keys);
+
+    aes_decrypt_block(round_keys, rounds, verifier + VERIFIER_INPUT, out);
+    for (int i = 0; i < 16; i++) {
+        out[i] ^= verifier[VERIFIER_IV + i];
+    }
+}
+
+/* Decrypts the verifier hash with the second derived key, AES-CBC, and compares it with the
+   hash of the decrypted verifier input. Almost every wrong password is rejected by the first
+   block, so the rest are only decrypted while the blocks match. */
+__device__ uint8_t verifier_hash_matches(
+    const uint8_t *key, uint32_t key_bytes, const uint8_t *verifier, const uint8_t *hash,
+    int hash_size)
+{
+    uint8_t round_keys[AES_MAX_ROUND_KEYS];
+    int rounds = aes_expand_key(key, key_bytes, round_keys);
+    const uint8_t *previous = verifier + VERIFIER_IV;
+
+    for (int offset = 0; offset < hash_size; offset += 16) {
+        const uint8_t *encrypted = verifier + VERIFIER_HASH + offset;
+        uint8_t block[16];
+        aes_decrypt_block(round_keys, rounds, encrypted, block);
+        for (int i = 0; i < 16; i++) {
+            if ((block[i] ^ previous[i]) != hash[offset + i]) {
+                return 0;
+            }
+        }
+        previous = encrypted;
+    }
+    return 1;
+}
+
+/* Writes SHA-512 state words as the big-endian bytes of the digest */
+__device__ __forceinline__ void store_sha512(const uint64_t h[8], uint8_t out[64])
+{
+#pragma unroll
+    for (int j = 0; j < 8; j++) {
+#pragma unroll
+        for (int b = 0; b < 8; b++) {
+            out[j * 8 + b] = (uint8_t)(h[j] >> (56 - 8 * b));
+        }
+    }
+}
+
+/* Writes SHA-256 state words as the big-endian bytes of the digest */
+__device__ __forceinline__ void store_sha256(const uint32_t h[8], uint8_t out[32])
+{
+#pragma unroll
+    for (int j = 0; j < 8; j++) {
+#pragma unroll
+        for (int b = 0; b < 4; b++) {
+            out[j * 4 + b] = (uint8_t)(h[j] >> (24 - 8 * b));
+        }
+    }
+}
+
+/* Computes SHA-512(hash + block key), which is the AES key before it is cut to size */
+__device__ void sha512_block_key(const uint64_t h[8], uint64_t block_key, uint8_t key[64])
+{
+    uint64_t w[16];
+    uint64_t digest[8];
+#pragma unroll
+    for (int j = 0; j < 8; j++) {
+        w[j] = h[j];
+    }
+    w[8] = block_key;
+    /* 72 bytes of message, then the 0x80 padding byte */
+    w[9] = 0x8000000000000000ULL;
+#pragma unroll
+    for (int j = 10; j < 15; j++) {
+        w[j] = 0;
+    }
+    w[15] = 72 * 8;
+
+    sha512_block(w, digest);
+    store_sha512(digest, key);
+}
+
+/* Computes SHA-256(hash + block key), which is the AES key before it is cut to size */
+__device__ void sha256_block_key(const uint32_t h[8], uint64_t block_key, uint8_t key[32])
+{
+    uint32_t w[16];
+    uint32_t digest[8];
+#pragma unroll
+    for (int j = 0; j < 8; j++) {
+        w[j] = h[j];
+    }
+    w[8] = (uint32_t)(block_key >> 32);
+    w[9] = (uint32_t)block_key;
+    /* 40 bytes of message, then the 0x80 padding byte */
+    w[10] = 0x80000000;
+#pragma unroll
+    for (int j = 11; j < 15; j++) {
+        w[j] = 0;
+    }
+    w[15] = 40 * 8;
+
+    sha256_block(w, digest);
+    store_sha256(digest, key);
+}
+
+/*
+ * h0s:        count initial hashes of 64 bytes each
+ * matches:    receives count flags, 1 where the password is correct and 0 elsewhere
+ * spin_count: the number of rounds, from the EncryptionInfo stream
+ * count:      the number of passwords
+ * verifier:   the IV and the encrypted verifier, laid out as described above
+ * key_bytes:  the size of the AES key, 16, 24 or 32
+ */
+extern "C" __global__ void verify_sha512(
+    const uint8_t *h0s, uint8_t *matches, uint32_t spin_count, uint32_t count,
+    const uint8_t *verifier, uint32_t key_bytes)
+{
+    uint32_t idx = blockIdx.x * blockDim.x + threadIdx.x;
+    if (idx >= count) {
+        return;
+    }
+
+    /* SHA-512 words are big-endian */
+    uint64_t h[8];
+    const uint8_t *in = h0s + (uint64_t)idx * 64;
+#pragma unroll
+    for (int j = 0; j < 8; j++) {
+        uint64_t v = 0;
+#pragma unroll
+        for (int b = 0; b < 8; b++) {
+            v = (v << 8) | in[j * 8 + b];
+        }
+        h[j] = v;
+    }
+
+    uint64_t w[16];
+    for (uint32_t i = 0; i < spin_count; i++) {
+        /* The message is the 4-byte little-endian iterator followed by the previous hash,
+           so every hash word straddles two message words */
+        uint64_t iterator = ((uint64_t)(i & 0xff) << 56) | ((uint64_t)((i >> 8) & 0xff) << 48)
+            | ((uint64_t)((i >> 16) & 0xff) << 40) | ((uint64_t)(i >> 24) << 32);
+        w[0] = iterator | (h[0] >> 32);
+#pragma unroll
+        for (int j = 1; j < 8; j++) {
+            w[j] = (h[j - 1] << 32) | (h[j] >> 32);
+        }
+        /* 68 bytes of message, then the 0x80 padding byte */
+        w[8] = (h[7] << 32) | 0x80000000ULL;
+#pragma unroll
+        for (int j = 9; j < 15; j++) {
+            w[j] = 0;
+        }
+        /* The message length in bits */
+        w[15] = 68 * 8;
+
+        sha512_block(w, h);
+    }
+
+    uint8_t key[64];
+    uint8_t input[16];
+    sha512_block_key(h, BLOCK_KEY_VERIFIER_HASH_INPUT, key);
+    decrypt_verifier_input(key, key_bytes, verifier, input);
+
+    /* SHA-512 of the 16-byte verifier input */
+    uint64_t input_hash[8];
+    uint8_t hash[64];
+    w[0] = 0;
+    w[1] = 0;
+#pragma unroll
+    for (int b = 0; b < 8; b++) {
+        w[0] = (w[0] << 8) | input[b];
+        w[1] = (w[1] << 8) | input[8 + b];
+    }
+    w[2] = 0x8000000000000000ULL;
+#pragma unroll
+    for (int j = 3; j < 15; j++) {
+        w[j] = 0;
+    }
+    w[15] = 16 * 8;
+    sha512_block(w, input_hash);
+    store_sha512(input_hash, hash);
+
+    sha512_block_key(h, BLOCK_KEY_VERIFIER_HASH_VALUE, key);
+    matches[idx] = verifier_hash_matches(key, key_bytes, verifier, hash, 64);
+}
+
+/* The same as verify_sha512, with 32-byte SHA-256 hashes */
+extern "C" __global__ void verify_sha256(
+    const uint8_t *h0s, uint8_t *matches, uint32_t spin_count, uint32_t count,
+    const uint8_t *verifier, uint32_t key_bytes)
+{
+    uint32_t idx = blockIdx.x * blockDim.x + threadIdx.x;
+    if (idx >= count) {
+        return;
+    }
+
+    /* SHA-256 words are big-endian */
+    uint32_t h[8];
+    const uint8_t *in = h0s + (uint64_t)idx * 32;
+#pragma unroll
+    for (int j = 0; j < 8; j++) {
+        h[j] = ((uint32_t)in[j * 4] << 24) | ((uint32_t)in[j * 4 + 1] << 16)
+            | ((uint32_t)in[j * 4 + 2] << 8) | (uint32_t)in[j * 4 + 3];
+    }
+
+    uint32_t w[16];
+    for (uint32_t i = 0; i < spin_count; i++) {
+        /* The 4-byte little-endian iterator is exactly one message word, so unlike SHA-512
+           the hash words line up with the message words */
+        w[0] = ((i & 0xff) << 24) | (((i >> 8) & 0xff) << 16) | (((i >> 16) & 0xff) << 8)
+            | (i >> 24);
+#pragma unroll
+        for (int j = 0; j < 8; j++) {
+            w[j + 1] = h[j];
+        }
+        /* 36 bytes of message, then the 0x80 padding byte */
+        w[9] = 0x80000000;
+#pragma unroll
+        for (int j = 10; j < 15; j++) {
+            w[j] = 0;
+        }
+        /* The message length in bits */
+        w[15] = 36 * 8;
+
+        sha256_block(w, h);
+    }
+
+    uint8_t key[32];
+    uint8_t input[16];
+    sha256_block_key(h, BLOCK_KEY_VERIFIER_HASH_INPUT, key);
+    decrypt_verifier_input(key, key_bytes, verifier, input);
+
+    /* SHA-256 of the 16-byte verifier input */
+    uint32_t input_hash[8];
+    uint8_t hash[32];
+#pragma unroll
+    for (int j = 0; j < 4; j++) {
+        w[j] = ((uint32_t)input[j * 4] << 24) | ((uint32_t)input[j * 4 + 1] << 16)
+            | ((uint32_t)input[j * 4 + 2] << 8) | (uint32_t)input[j * 4 + 3];
+    }
+    w[4] = 0x80000000;
+#pragma unroll
+    for (int j = 5; j < 15; j++) {
+        w[j] = 0;
+    }
+    w[15] = 16 * 8;
+    sha256_block(w, input_hash);
+    store_sha256(input_hash, hash);
+
+    sha256_block_key(h, BLOCK_KEY_VERIFIER_HASH_VALUE, key);
+    matches[idx] = verifier_hash_matches(key, key_bytes, verifier, hash, 32);
+}
@@ -0,0 +1,199 @@
+/*
+ * C extension for the part of ECMA-376 password verification that dominates the running
+ * time: hashing the password spinCount times (usually 100,000 for Agile and always 50,000
+ * for Standard Encryption).
+ *
+ * Doing the loop in Python costs a bytes allocation, a hashlib call and an int-to-bytes
+ * conversion for every round. Here the whole loop runs in C against a single OpenSSL
+ * EVP_MD_CTX and a single buffer.
+ *
+ * Build with: python setup.py build_ext --inplace
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+#include <string.h>
+#include <openssl/crypto.h>
+#include <openssl/evp.h>
+
+/*
+ * OpenSSL picks the fastest code for the CPU at runtime: the SHA extensions (SHA-NI) for
+ * SHA-1 and SHA-256 on x86_64, AVX2/AVX-512 for SHA-512, and the SHA instructions on ARMv8.
+ * On OpenSSL 3, passing EVP_sha512() to EVP_DigestInit_ex looks the implementation up in the
+ * provider on every call, which costs more than hashing 68 bytes, so every hash algorithm
+ * ECMA-376 allows is fetched once when the module loads.
+ */
+static const char *digest_names[] = {"SHA1", "SHA256", "SHA384", "SHA512"};
+#define DIGEST_COUNT (sizeof(digest_names) / sizeof(digest_names[0]))
+static const EVP_MD *digests[DIGEST_COUNT];
+
+/*
+ * Finishes count hash chains in place. Each chain is a (4-byte iterator + hash) block of
+ * 4 + size bytes, holding the initial hash on entry and the final hash on return.
+ * Returns 0 if OpenSSL fails.
+ */
+static int
+spin_blocks(const EVP_MD *md, int size, unsigned char *blocks, Py_ssize_t count,
+            uint32_t spin_count)
+{
+    EVP_MD_CTX *ctx = EVP_MD_CTX_new();
+    int ok = ctx != NULL;
+
+    for (Py_ssize_t n = 0; n < count && ok; n++) {
+        unsigned char *block = blocks + n * (4 + size);
+        for (uint32_t i = 0; i < spin_count && ok; i++) {
+            block[0] = (unsigned char)(i);
+            block[1] = (unsigned char)(i >> 8);
+            block[2] = (unsigned char)(i >> 16);
+            block[3] = (unsigned char)(i >> 24);
+            ok = EVP_DigestInit_ex(ctx, md, NULL)
+                && EVP_DigestUpdate(ctx, block, 4 + size)
+                && EVP_DigestFinal_ex(ctx, block + 4, NULL);
+        }
+    }
+
+    EVP_MD_CTX_free(ctx);
+    return ok;
+}
+
+/*
+ * Runs spin_blocks over the initial hashes joined together in h0s and returns the final
+ * hashes joined in the same order. The GIL is released while hashing.
+ */
+static PyObject *
+spin_joined(const EVP_MD *md, Py_buffer *h0s, uint32_t spin_count)
+{
+    int size = EVP_MD_size(md);
+    Py_ssize_t count;
+    unsigned char *blocks;
+    PyObject *result;
+    int ok;
+
+    if (h0s->len % size != 0) {
+        PyErr_Format(PyExc_ValueError, "h0s must be a multiple of %d bytes long", size);
+        return NULL;
+    }
+    count = h0s->len / size;
+
+    /* One (iterator + hash) block per chain */
+    blocks = PyMem_Malloc(count * (4 + size) + 1);
+    if (blocks == NULL) {
+        return PyErr_NoMemory();
+    }
+    for (Py_ssize_t n = 0; n < count; n++) {
+        memcpy(blocks + n * (4 + size) + 4, (const unsigned char *)h0s->buf + n * size, size);
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    ok = spin_blocks(md, size, blocks, count, spin_count);
+    Py_END_ALLOW_THREADS
+
+    if (!ok) {
+        PyMem_Free(blocks);
+        PyErr_SetString(PyExc_RuntimeError, "OpenSSL failed to compute the hash");
+        return NULL;
+    }
+
+    result = PyBytes_FromStringAndSize(NULL, count * size);
+    if (result != NULL) {
+        for (Py_ssize_t n = 0; n < count; n++) {
+            memcpy(PyBytes_AS_STRING(result) + n * size, blocks + n * (4 + size) + 4, size);
+        }
+    }
+    PyMem_Free(blocks);
+    return result;
+}
+
+/*
+ * openssl_info() -> str
+ *
+ * Returns the OpenSSL version and, when OpenSSL can report it, the CPU capabilities it
+ * detected. This shows whether the assembly SHA-512 code paths are in use.
+ */
+static PyObject *
+openssl_info(PyObject *self, PyObject *Py_UNUSED(ignored))
+{
+#ifdef OPENSSL_CPU_INFO
+    return PyUnicode_FromFormat("%s (%s)",
+                                OpenSSL_version(OPENSSL_VERSION),
+                                OpenSSL_version(OPENSSL_CPU_INFO));
+#else
+    return PyUnicode_FromString(OpenSSL_version(OPENSSL_VERSION));
+#endif
+}
+
+/*
+ * spin_hash_batch(algorithm: str, h0s: bytes, spin_count: int) -> bytes
+ *
+ * Runs the spin loop for several passwords at once, with any hash algorithm ECMA-376 allows,
+ * named as in the EncryptionInfo stream ("SHA1", "SHA256", "SHA384" or "SHA512"). h0s is the
+ * initial hashes of the passwords joined together, each the digest size of that algorithm,
+ * and the result is the final hashes joined in the same order.
+ *
+ * One call covers a whole batch of passwords, so the Python call and argument parsing are
+ * paid once per batch, and the GIL is released while hashing. Each chain is finished before
+ * the next one starts; interleaving the chains round-robin measured slightly slower because
+ * OpenSSL's hashes are already a single tight loop per call.
+ */
+static PyObject *
+spin_hash_batch(PyObject *self, PyObject *args)
+{
+    const char *algorithm;
+    Py_buffer h0s;
+    unsigned int spin_count;
+    const EVP_MD *md = NULL;
+    PyObject *result;
+
+    if (!PyArg_ParseTuple(args, "sy*I", &algorithm, &h0s, &spin_count)) {
+        return NULL;
+    }
+    for (size_t d = 0; d < DIGEST_COUNT; d++) {
+        if (strcmp(algorithm, digest_names[d]) == 0) {
+            md = digests[d];
+        }
+    }
+    if (md == NULL) {
+        PyBuffer_Release(&h0s);
+        PyErr_Format(PyExc_ValueError, "unsupported hash algorithm: %s", algorithm);
+        return NULL;
+    }
+    result = spin_joined(md, &h0s, spin_count);
+    PyBuffer_Release(&h0s);
+    return result;
+}
+
+static PyMethodDef agile_verify_methods[] = {
+    {"spin_hash_batch", spin_hash_batch, METH_VARARGS,
+     "spin_hash_batch(algorithm, h0s, spin_count) -> bytes\n\n"
+     "Run the spin loop with the named hash algorithm (SHA1, SHA256, SHA384 or SHA512) for\n"
+     "each initial hash in h0s and return the results joined together."},
+    {"openssl_info", openssl_info, METH_NOARGS,
+     "openssl_info() -> str\n\n"
+     "Return the OpenSSL version and the CPU capabilities it detected."},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef agile_verify_module = {
+    PyModuleDef_HEAD_INIT,
+    "agile_verify",
+    "Native hash loop for ECMA-376 password verification.",
+    -1,
+    agile_verify_methods
+};
+
+PyMODINIT_FUNC
+PyInit_agile_verify(void)
+{
+    for (size_t d = 0; d < DIGEST_COUNT; d++) {
+#if OPENSSL_VERSION_NUMBER >= 0x30000000L
+        digests[d] = EVP_MD_fetch(NULL, digest_names[d], "provider=default");
+#else
+        digests[d] = EVP_get_digestbyname(digest_names[d]);
+#endif
+        if (digests[d] == NULL) {
+            PyErr_Format(PyExc_ImportError, "OpenSSL does not provide %s", digest_names[d]);
+            return NULL;
+        }
+    }
+    return PyModule_Create(&agile_verify_module);
+}
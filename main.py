@@ -1,26 +1,128 @@
 import itertools
 import argparse
-import csv
+import hashlib
+import importlib.util
+import json
+import multiprocessing
 import os
+import queue
+import signal
 import string
 import sys
 import time
-from typing import Generator, List, Optional, Tuple
+from functools import lru_cache
+from typing import Generator, List, NamedTuple, Optional, Tuple
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from msoffcrypto.format.ooxml import OOXMLFile
 import msoffcrypto
+import olefile
+
+try:
+    # Optional C extension that runs the spin loop in OpenSSL.
+    # Build it with: python setup.py build_ext --inplace
+    from agile_verify import openssl_info, spin_hash_batch
+except ImportError:
+    openssl_info = None
+    spin_hash_batch = None
 
 
 OUTPUT_FOLDER = "checked_files"
 
+# Number of passwords sent to a worker process at a time
+CHUNK_SIZE = 256
+
+# Number of worker processes that drive the GPU. While one waits for its kernel, the other
+# generates its next batch and hashes the initial hashes, so the GPU is not left idle
+GPU_PROCESSES = 2
+
+# CUDA source for the GPU versions of the SHA-512 and SHA-256 password checks
+CUDA_SOURCE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "agile_spin.cu")
+
+# Hash algorithms that agile_spin.cu has a password check for
+CUDA_HASH_ALGORITHMS = ("SHA256", "SHA512")
+
+# Number of tasks queued per worker process; more would only use memory, since tasks are
+# generated far faster than they are checked
+TASKS_PER_PROCESS = 2
+
+# Seconds between updates of the status line while passwords are checked
+STATUS_INTERVAL = 1.0
+
+# Number of checked passwords between saves of the progress file
+CHECKPOINT_INTERVAL = 10000
+
+# Encrypted OOXML files are stored in an OLE compound file, which starts with this signature
+CFB_SIGNATURE = b"\xD0\xCF\x11\xE0\xA1\xB1\x1A\xE1"
+
+# Unencrypted OOXML files are ZIP archives, which start with this signature
+ZIP_SIGNATURE = b"PK\x03\x04"
+
+# The Agile or Standard verifier parameters, when the file uses one of those encryption types
+_worker_params = None
+
+# The GPU versions of the password check keyed by hash algorithm, when the worker process was
+# started with use_gpu
+_worker_cuda_verifiers: Optional[dict] = None
+
+# Hash algorithms allowed by ECMA-376 Agile Encryption, keyed by their EncryptionInfo name
+HASH_ALGORITHMS = {
+    "SHA1": hashlib.sha1,
+    "SHA256": hashlib.sha256,
+    "SHA384": hashlib.sha384,
+    "SHA512": hashlib.sha512,
+}
+
+# Block keys used to derive the keys that decrypt the password verifier
+# https://learn.microsoft.com/en-us/openspecs/office_file_formats/ms-offcrypto/a57cb947-554f-4e5e-b150-3f2978225e92
+BLOCK_KEY_VERIFIER_HASH_INPUT = bytes([0xFE, 0xA7, 0xD2, 0x76, 0x3B, 0x4B, 0x9E, 0x79])
+BLOCK_KEY_VERIFIER_HASH_VALUE = bytes([0xD7, 0xAA, 0x0F, 0x6D, 0x30, 0x61, 0x34, 0x4E])
+
+# Standard Encryption always iterates the SHA-1 password hash this many times
+# https://learn.microsoft.com/en-us/openspecs/office_file_formats/ms-offcrypto/de3a1bb5-a6d2-4b15-8b2d-fd1f64c1b0a8
+STANDARD_SPIN_COUNT = 50000
+
+class AgileParams(NamedTuple):
+    """
+    The values from an Agile EncryptionInfo stream that are needed to verify a password.
+    """
+    salt: bytes
+    spin_count: int
+    encrypted_verifier_hash_input: bytes
+    encrypted_verifier_hash_value: bytes
+    key_bits: int
+    hash_algorithm: str
+
+class StandardParams(NamedTuple):
+    """
+    The values from a Standard EncryptionInfo stream that are needed to verify a password.
+    """
+    salt: bytes
+    key_bits: int
+    encrypted_verifier: bytes
+    encrypted_verifier_hash: bytes
+
  # Helper: produce all case variations for a string
-def case_variations(s: str):
+def case_variations(s: str) -> List[str]:
     """
     Generate all case variations for a given string.
+    The variations are built as a table indexed by bitmask: bit j of an index is set when the
+    j-th letter of the string is upper case. Each letter doubles the table, so every variation
+    costs one string concatenation per character instead of a tuple and a join.
     :param s: The input string.
-    :return: A generator yielding all case variations of the string.
+    :return: A list of all case variations of the string.
     """
-    variants = [(ch.lower(), ch.upper()) if ch.isalpha() else (ch,) for ch in s]
-    return (''.join(candidate) for candidate in itertools.product(*variants))
+    # Strings without letters, like "2021" or "202!", only have one variation
+    if s.lower() == s.upper():
+        return [s]
+
+    variations = [""]
+    for ch in s:
+        lower, upper = ch.lower(), ch.upper()
+        if lower != upper:
+            variations = [v + c for c in (lower, upper) for v in variations]
+        else:
+            variations = [v + ch for v in variations]
+    return variations
 
 def positive_int(value: str) -> int:
     """
@@ -38,6 +140,22 @@ def positive_int(value: str) -> int:
         raise argparse.ArgumentTypeError("Value must be a positive integer greater than 0")
     return ivalue
 
+def shard_arg(value: str) -> Tuple[int, int]:
+    """
+    Argument type for the shard parameter, written as i/N: shard i of N, counting from 0.
+
+    :param value: The input value to check.
+    :return: A tuple of the shard and the number of shards.
+    :raises argparse.ArgumentTypeError: If the value is not a valid shard.
+    """
+    try:
+        shard, shards = (int(part) for part in value.split("/"))
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(f"{value} is not a shard like 0/4") from exc
+    if shards <= 0 or not 0 <= shard < shards:
+        raise argparse.ArgumentTypeError("The shard must be from 0 to the number of shards - 1")
+    return shard, shards
+
 def process_arg(arg_str: str) -> list[str]:
     """
     Processes a comma-separated argument string:
@@ -86,6 +204,18 @@ def parse_args():
         default=10,
         help="Max length of the password (positive integer greater than 0)."
     )
+    parser.add_argument(
+        "--gpu",
+        action="store_true",
+        help="Run the SHA-512/SHA-256 hashing on an NVIDIA GPU (requires CuPy)."
+    )
+    parser.add_argument(
+        "--shard",
+        type=shard_arg,
+        default=None,
+        help="Only check shard i of N equal parts of the passwords, counting from 0 "
+        "(e.g., '0/4' on one machine, '1/4' on the next)."
+    )
 
     # If no arguments are provided, print the help message
     if len(sys.argv) == 1:
@@ -94,21 +224,127 @@ def parse_args():
 
     return parser.parse_args()
 
-def generate_passwords(
+def enumerate_length(
+    first_chars: str,
+    rest_chars: str,
+    length: int,
+    start: int = 0,
+    stop: Optional[int] = None,
+    prefix: str = "",
+    suffix: str = ""
+) -> Generator[str, None, None]:
+    """
+    Enumerates the password bodies of one length in order. The body at index idx is idx
+    written as a mixed-radix number: the first digit picks from first_chars and every other
+    digit picks from rest_chars, with the last character changing fastest. This lets any
+    range of bodies be generated without generating the bodies before it.
+
+    :param first_chars: The characters allowed as the first character of the body.
+    :param rest_chars: The characters allowed for the rest of the body.
+    :param length: The length of the bodies (positive integer greater than 0).
+    :param start: The index of the first body to generate (default is 0).
+    :param stop: The index after the last body to generate (default is all of them).
+    :param prefix: Text added before every body (default is none).
+    :param suffix: Text added after every body (default is none).
+    :return: A generator yielding the bodies from start up to stop.
+
+    The characters can also be given as sequences of encoded characters, with bytes for the
+    prefix and suffix, in which case encoded bodies are generated (see iter_segment_utf16).
+    """
+    pools = [first_chars] + [rest_chars] * (length - 1)
+    total = len(first_chars) * len(rest_chars) ** (length - 1)
+    stop = total if stop is None else min(stop, total)
+    if start >= stop:
+        return
+
+    # Decode the start index into one digit per character
+    digits = []
+    remainder = start
+    for pool in reversed(pools):
+        remainder, digit = divmod(remainder, len(pool))
+        digits.append(digit)
+    digits.reverse()
+
+    # Continue counting from the start index: for each position from the last to the first,
+    # keep the characters before it, advance it, and let every position after it run in full.
+    # itertools.product and map("".join) build every body in C, with the prefix folded into
+    # the leading characters and the suffix added as a last pool of one, so whole passwords
+    # come out of C without another concatenation per password.
+    tail = [(suffix,)] if suffix else []
+    join = b"".join if isinstance(prefix, bytes) else "".join
+
+    def bodies_from_start():
+        for position in range(length - 1, -1, -1):
+            head = prefix + join(pool[digit] for pool, digit in zip(pools, digits[:position]))
+            first_digit = digits[position] if position == length - 1 else digits[position] + 1
+            leads = [head + char for char in pools[position][first_digit:]]
+            yield from map(join, itertools.product(leads, *pools[position + 1:], *tail))
+
+    yield from itertools.islice(bodies_from_start(), stop - start)
+
+class Segment(NamedTuple):
+    """
+    A run of passwords that share a prefix, a suffix and a body length. The password at
+    index idx of the segment is prefix + body idx + suffix (see enumerate_length).
+    A length of 0 means the segment is the single password prefix + suffix.
+    start and stop limit a run to part of the segment (see shard_keyspace); indexes are
+    always counted from the start of the whole segment.
+    """
+    prefix: str
+    suffix: str
+    length: int
+    first_chars: str
+    rest_chars: str
+    start: int = 0
+    stop: Optional[int] = None
+
+    @property
+    def key(self) -> str:
+        """
+        A name for the segment that stays the same between runs, used for saving progress.
+        """
+        return json.dumps([self.prefix, self.length, self.suffix])
+
+    @property
+    def total(self) -> int:
+        """
+        The number of passwords in the whole segment.
+        """
+        if self.length == 0:
+            return 1
+        return len(self.first_chars) * len(self.rest_chars) ** (self.length - 1)
+
+    @property
+    def end(self) -> int:
+        """
+        The index after the last password this run covers.
+        """
+        return self.total if self.stop is None else min(self.stop, self.total)
+
+    @property
+    def size(self) -> int:
+        """
+        The number of passwords this run covers.
+        """
+        return max(self.end - self.start, 0)
+
+def build_keyspace(
     prefixes: Optional[List[str]] = None,
     suffixes: Optional[List[str]] = None,
     max_length: int = 10
-) -> Generator[str, None, None]:
+) -> List[Segment]:
     """
-    Generates all possible passwords based on the provided prefixes, suffixes, and maximum length.
+    Splits every password that generate_passwords produces into segments, in a fixed order.
+    Any password can then be found from its segment and its index within the segment, which
+    is how progress is saved and resumed.
     All case variations are created for the prefixes and suffixes regardless of max_length.
-    If no suffixes are specified, generate all case variations of the prefixes alone and then
-    generate all passwords using each prefix up to the max_length.
+    If no suffixes are specified, use all case variations of the prefixes alone and then
+    all passwords using each prefix up to the max_length.
 
     :param prefixes: List of prefixes to use (default is None).
     :param suffixes: List of suffixes to use (default is None).
     :param max_length: Maximum length of the passwords to generate (default is 10).
-    :return: A generator yielding password combinations.
+    :return: The list of segments.
     """
 
     # Letters for the first character if no prefix is provided
@@ -118,63 +354,202 @@ def generate_passwords(
     valid_chars = letters + string.digits + string.punctuation
 
     # Prepare all case variations for prefixes (or just an empty string if no prefixes)
+    # These are sorted so the segments are in the same order every run
     prefixes = prefixes or [""]
     prefix_variations = set()
     for prefix in prefixes:
         prefix_variations.update(case_variations(prefix))
+    prefix_variations = sorted(prefix_variations)
 
     # Prepare all case variations for suffixes (or just an empty string if no suffixes)
     suffixes = suffixes or [""]
     suffix_variations = set()
     for suffix in suffixes:
         suffix_variations.update(case_variations(suffix))
+    suffix_variations = sorted(suffix_variations)
+
+    keyspace = []
 
-    # If no suffixes are specified, generate all case variations of the prefixes alone
+    # If no suffixes are specified, use all case variations of the prefixes alone
     if not suffixes or suffixes == [""]:
         for prefix in prefix_variations:
             if len(prefix) <= max_length:
-                yield prefix
+                keyspace.append(Segment(prefix, "", 0, "", ""))
 
-        # Generate all passwords using each prefix up to the max_length
+        # Then all passwords using each prefix up to the max_length
         for prefix in prefix_variations:
             remaining_length = max_length - len(prefix)
-            if remaining_length > 0:
-                for length in range(1, remaining_length + 1):
-                    char_pool = [valid_chars] * length
-                    for body_chars in itertools.product(*char_pool):
-                        body = ''.join(body_chars)
-                        yield prefix + body
-        return  # Skip the rest of the logic since suffixes are not specified
-
-    # Generate passwords by combining prefixes, generated body, and suffixes
+            for length in range(1, remaining_length + 1):
+                keyspace.append(Segment(prefix, "", length, valid_chars, valid_chars))
+        return keyspace  # Skip the rest of the logic since suffixes are not specified
+
+    # Combine prefixes, generated body, and suffixes
     for prefix in prefix_variations:
         for suffix in suffix_variations:
             total_fixed_length = len(prefix) + len(suffix)
 
-            # If prefix + suffix fills max_length already
-            if total_fixed_length > max_length:
-                remaining_length = 0
-            else:
-                remaining_length = max_length - total_fixed_length
-
-            # If there's no space for a body, just yield prefix + suffix
-            if remaining_length == 0:
-                yield prefix + suffix
+            # If prefix + suffix fills max_length already, there's no space for a body
+            if total_fixed_length >= max_length:
+                keyspace.append(Segment(prefix, suffix, 0, "", ""))
                 continue
 
             # Character pools: first char special if no prefix
             first_chars = letters if prefix == "" else valid_chars
 
-            # Generate all possible combinations for the body of the password
-            for length in range(1, remaining_length + 1):
-                if length == 1:
-                    char_pool = [first_chars]
-                else:
-                    char_pool = [first_chars] + [valid_chars] * (length - 1)
+            # All possible bodies of the password
+            for length in range(1, max_length - total_fixed_length + 1):
+                keyspace.append(Segment(prefix, suffix, length, first_chars, valid_chars))
+
+    return keyspace
 
-                for body_chars in itertools.product(*char_pool):
-                    body = ''.join(body_chars)
-                    yield prefix + body + suffix
+def iter_segment(
+    segment: Segment,
+    start: int = 0,
+    stop: Optional[int] = None
+) -> Generator[str, None, None]:
+    """
+    Generates the passwords of a segment from index start up to stop.
+
+    :param segment: The segment to generate.
+    :param start: The index of the first password (default is 0).
+    :param stop: The index after the last password (default is the end of the segment).
+    :return: A generator yielding the passwords.
+    """
+    if segment.length == 0:
+        if start == 0 and (stop is None or stop > 0):
+            yield segment.prefix + segment.suffix
+        return
+
+    yield from enumerate_length(
+        segment.first_chars,
+        segment.rest_chars,
+        segment.length,
+        start,
+        stop,
+        segment.prefix,
+        segment.suffix
+    )
+
+@lru_cache(maxsize=None)
+def _utf16_chars(chars: str) -> Tuple[bytes, ...]:
+    """
+    Encodes each character of a character pool as UTF-16LE, once per pool.
+    """
+    return tuple(char.encode("utf-16-le") for char in chars)
+
+def iter_segment_utf16(
+    segment: Segment,
+    start: int = 0,
+    stop: Optional[int] = None
+) -> Generator[bytes, None, None]:
+    """
+    Generates the passwords of a segment like iter_segment, but already encoded as UTF-16LE,
+    the encoding the verifier hashes. The characters are encoded once per pool and joined as
+    bytes, which is much faster than joining strings and encoding every password.
+
+    :param segment: The segment to generate.
+    :param start: The index of the first password (default is 0).
+    :param stop: The index after the last password (default is the end of the segment).
+    :return: A generator yielding the encoded passwords.
+    """
+    prefix = segment.prefix.encode("utf-16-le")
+    suffix = segment.suffix.encode("utf-16-le")
+    if segment.length == 0:
+        if start == 0 and (stop is None or stop > 0):
+            yield prefix + suffix
+        return
+
+    yield from enumerate_length(
+        _utf16_chars(segment.first_chars),
+        _utf16_chars(segment.rest_chars),
+        segment.length,
+        start,
+        stop,
+        prefix,
+        suffix
+    )
+
+def generate_passwords(
+    prefixes: Optional[List[str]] = None,
+    suffixes: Optional[List[str]] = None,
+    max_length: int = 10
+) -> Generator[str, None, None]:
+    """
+    Generates all possible passwords based on the provided prefixes, suffixes, and maximum length.
+    See build_keyspace for the passwords that are generated and their order.
+
+    :param prefixes: List of prefixes to use (default is None).
+    :param suffixes: List of suffixes to use (default is None).
+    :param max_length: Maximum length of the passwords to generate (default is 10).
+    :return: A generator yielding password combinations.
+    """
+    for segment in build_keyspace(prefixes, suffixes, max_length):
+        yield from iter_segment(segment)
+
+def password_at(keyspace: List[Segment], index: int) -> str:
+    """
+    Finds a password from its position in the keyspace without generating the passwords
+    before it. Positions count every password of every segment in order.
+
+    :param keyspace: The segments of the keyspace (see build_keyspace).
+    :param index: The position of the password (0 is the first password).
+    :return: The password at that position.
+    :raises IndexError: If the position is past the end of the keyspace.
+    """
+    for segment in keyspace:
+        if index < segment.total:
+            return next(iter_segment(segment, index, index + 1))
+        index -= segment.total
+    raise IndexError("Password index out of range")
+
+def generate_range(
+    keyspace: List[Segment],
+    start: int,
+    stop: int
+) -> Generator[str, None, None]:
+    """
+    Generates the passwords at positions start up to stop of the keyspace (see password_at).
+
+    :param keyspace: The segments of the keyspace (see build_keyspace).
+    :param start: The position of the first password.
+    :param stop: The position after the last password.
+    :return: A generator yielding the passwords.
+    """
+    for segment in shard_range(keyspace, start, stop):
+        yield from iter_segment(segment, segment.start, segment.end)
+
+def shard_range(keyspace: List[Segment], start: int, stop: int) -> List[Segment]:
+    """
+    Limits the keyspace to the passwords at positions start up to stop (see password_at).
+    Segments outside the range are dropped and the ones at either end are cut to fit.
+
+    :param keyspace: The segments of the keyspace (see build_keyspace).
+    :param start: The position of the first password.
+    :param stop: The position after the last password.
+    :return: The segments covering the range.
+    """
+    shard = []
+    offset = 0
+    for segment in keyspace:
+        segment_start = max(start - offset, 0)
+        segment_stop = min(stop - offset, segment.total)
+        if segment_start < segment_stop:
+            shard.append(segment._replace(start=segment_start, stop=segment_stop))
+        offset += segment.total
+    return shard
+
+def shard_keyspace(keyspace: List[Segment], shard: int, shards: int) -> List[Segment]:
+    """
+    Splits the keyspace into shards of nearly equal size and returns one of them, so that
+    several machines (or GPUs) can each search their own part of it.
+
+    :param keyspace: The segments of the keyspace (see build_keyspace).
+    :param shard: Which shard to return, from 0 to shards - 1.
+    :param shards: The number of shards.
+    :return: The segments of the shard.
+    """
+    total = sum(segment.total for segment in keyspace)
+    return shard_range(keyspace, shard * total // shards, (shard + 1) * total // shards)
 
 # def generate_all_passwords(max_length: int = 10) -> Generator[str, None, None]:
 #     """
@@ -186,13 +561,13 @@ def generate_passwords(
 #     """
 
 #     # Define the character set: all printable ASCII characters except whitespace and control chars
-#     valid_chars = string.ascii_letters + string.digits + string.punctuation
+#     letters = string.ascii_letters
+#     valid_chars = letters + string.digits + string.punctuation
 
 #     # Generate passwords starting with a letter and up to max_length characters
+#     # The first character comes from its own pool of letters, so no passwords are thrown away
 #     for length in range(1, max_length + 1):
-#         for password in itertools.product(valid_chars, repeat=length):
-#             if password[0].isalpha():  # Ensure the password starts with a letter
-#                 yield ''.join(password)
+#         yield from map("".join, itertools.product(letters, *[valid_chars] * (length - 1)))
 
 
 
@@ -212,8 +587,28 @@ def file_is_encrypted(file_path:str) -> bool:
     # msoffcrypto-tool file.xlsx --test -v
     # Opening a file in Python as "rb" means read-only for a binary file
     with open(file_path, "rb") as file:
+        # The first bytes of the file answer the question without parsing the whole container
+        signature = file.read(len(CFB_SIGNATURE))
+        if signature == CFB_SIGNATURE:
+            # Legacy .xls and .doc files are compound files too; only encrypted OOXML files
+            # have an EncryptionInfo stream, so the rest are ruled out by the directory alone
+            file.seek(0)
+            try:
+                with olefile.OleFileIO(file) as ole:
+                    if not ole.exists("EncryptionInfo"):
+                        return False
+            except OSError:
+                print("FileFormatError: Failed to confirm if the file is encrypted.")
+                return False
+
+        # Anything that is neither a compound file nor a ZIP archive is not an OOXML file
+        elif not signature.startswith(ZIP_SIGNATURE):
+            return False
+
+        file.seek(0)
         try:
-            # Attempt to decrypt the file
+            # Parsing the file also parses its EncryptionInfo, which fails for encryption types
+            # that cannot be checked
             officefile = OOXMLFile(file)
             return officefile.is_encrypted()
 
@@ -229,27 +624,51 @@ def file_is_encrypted(file_path:str) -> bool:
         # unnecessary attempts to test the password
         return False
 
-def get_checked_passwords(file_path:str) -> set[str]:
+def get_progress_path(file_path:str, shard: Optional[Tuple[int, int]] = None) -> str:
     """
-    Get a list of passwords already checked for the given file to save time.
+    Get the path of the file that records how far the search got for the given file.
+    Each shard has its own, so shards can run side by side from the same folder.
     """
-
     file_name = os.path.basename(file_path)
-    checked_file_path = os.path.join(OUTPUT_FOLDER, f"{file_name}.csv")
+    if shard is not None:
+        file_name = f"{file_name}.shard-{shard[0]}-of-{shard[1]}"
+    return os.path.join(OUTPUT_FOLDER, f"{file_name}.progress.json")
+
+def load_progress(file_path:str, shard: Optional[Tuple[int, int]] = None) -> dict:
+    """
+    Get the progress of earlier runs for the given file to save time. The progress has two parts:
+      - "next": for each segment of the keyspace, the index of the first password that has
+        not been checked yet.
+      - "done": for each segment, the [start, stop) ranges after that index that were
+        already checked, because the workers finish their tasks out of order.
+    """
+    progress = {"next": {}, "done": {}}
 
     # Create the output folder if it doesn't exist
     if not os.path.exists(OUTPUT_FOLDER):
         os.makedirs(OUTPUT_FOLDER)
-        return set()
+        return progress
+
+    progress_path = get_progress_path(file_path, shard)
+    if not os.path.exists(progress_path):
+        return progress
 
-    checked_passwords = set()
-    if os.path.exists(checked_file_path):
-        with open(checked_file_path, mode='r', encoding='utf-8') as file:
-            reader = csv.reader(file)
-            for row in reader:
-                checked_passwords.add(row[0])
+    with open(progress_path, mode='r', encoding='utf-8') as file:
+        progress.update(json.load(file))
+    return progress
 
-    return checked_passwords
+def save_progress(file_path:str, progress: dict, shard: Optional[Tuple[int, int]] = None):
+    """
+    Save the progress for the given file. The progress is written to a temporary file and
+    synced to disk before it replaces the old one, so a crash never leaves it half-written.
+    """
+    progress_path = get_progress_path(file_path, shard)
+    temp_path = f"{progress_path}.tmp"
+    with open(temp_path, mode='w', encoding='utf-8') as file:
+        json.dump(progress, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, progress_path)
 
 def print_completion_message(start_time, password:str, num_checked:int, num_skipped:int):
     """
@@ -272,88 +691,648 @@ def print_completion_message(start_time, password:str, num_checked:int, num_skip
           {elapsed_time:.2f} seconds ({(num_checked+num_skipped)/elapsed_time} pwds/sec).""")
 
 
-def test_passwords(excel_file, password_list: Generator[str]):
+def get_agile_params(officefile: OOXMLFile) -> Optional[AgileParams]:
+    """
+    Extracts the password verifier from an already parsed file so that it does not have
+    to be parsed again for every password.
+
+    :param officefile: The parsed encrypted file.
+    :return: The verifier parameters, or None if the file does not use Agile Encryption.
+    """
+    if getattr(officefile, "type", None) != "agile":
+        return None
+
+    info = officefile.info
+    return AgileParams(
+        salt=info["passwordSalt"],
+        spin_count=info["spinValue"],
+        encrypted_verifier_hash_input=info["encryptedVerifierHashInput"],
+        encrypted_verifier_hash_value=info["encryptedVerifierHashValue"],
+        key_bits=info["passwordKeyBits"],
+        hash_algorithm=info["passwordHashAlgorithm"],
+    )
+
+def _resize(buffer: bytes, size: int, pad: bytes) -> bytes:
+    """
+    Truncates or pads a buffer to the given size, as required for derived keys and IVs.
+    """
+    return buffer[:size] + pad * (size - len(buffer))
+
+def _decrypt_aes_cbc(data: bytes, key: bytes, iv: bytes) -> bytes:
+    """
+    Decrypts data with AES in CBC mode without padding.
+    """
+    decryptor = Cipher(algorithms.AES(key), modes.CBC(iv)).decryptor()
+    return decryptor.update(data) + decryptor.finalize()
+
+@lru_cache(maxsize=2)
+def _spin_iterators(spin_count: int) -> Tuple[bytes, ...]:
+    """
+    The 4-byte little-endian iterators of the spin loop. They are the same for every password,
+    so they are built once instead of once per round.
+    """
+    return tuple(i.to_bytes(4, "little") for i in range(spin_count))
+
+def _spin(h: bytes, spin_count: int, hash_func) -> bytes:
+    """
+    Iterates the password hash: Hn = H(iterator + Hn-1) for spin_count rounds.
+    This is the pure Python version of the agile_verify C extension.
+    """
+    for iterator in _spin_iterators(spin_count):
+        h = hash_func(iterator + h).digest()
+    return h
+
+def _spin_batch(initial_hashes: List[bytes], spin_count: int, hash_algorithm: str) -> List[bytes]:
+    """
+    Runs the spin loop for a batch of initial hashes, in OpenSSL when the agile_verify C
+    extension is built (which uses the SHA extensions of the CPU for SHA-1 and SHA-256).
+
+    :param initial_hashes: The initial hash H0 of each password.
+    :param spin_count: The number of times each hash is iterated.
+    :param hash_algorithm: The hash algorithm named in the EncryptionInfo stream.
+    :return: The final hash of each password.
+    """
+    hash_func = HASH_ALGORITHMS.get(hash_algorithm, hashlib.sha1)
+    if spin_hash_batch is None or hash_algorithm not in HASH_ALGORITHMS:
+        return [_spin(h, spin_count, hash_func) for h in initial_hashes]
+
+    size = hash_func().digest_size
+    joined = spin_hash_batch(hash_algorithm, b"".join(initial_hashes), spin_count)
+    return [joined[i:i + size] for i in range(0, len(joined), size)]
+
+def _check_agile_hash(h: bytes, params: AgileParams) -> bool:
+    """
+    Finishes an Agile password check once the password hash has been iterated: derives the
+    two verifier keys from the final hash and checks that the decrypted verifier matches its
+    decrypted hash.
+
+    :param h: The final iterated password hash.
+    :param params: The Agile verifier parameters.
+    :return: True if the password the hash came from is correct.
+    """
+    hash_func = HASH_ALGORITHMS.get(params.hash_algorithm, hashlib.sha1)
+    key_size = params.key_bits // 8
+
+    # Each block key produces a different AES key from the same final hash
+    key1 = _resize(hash_func(h + BLOCK_KEY_VERIFIER_HASH_INPUT).digest(), key_size, b"\x36")
+    key2 = _resize(hash_func(h + BLOCK_KEY_VERIFIER_HASH_VALUE).digest(), key_size, b"\x36")
+
+    # The salt is also the IV for the verifier
+    iv = _resize(params.salt, 16, b"\x36")
+    verifier = _decrypt_aes_cbc(params.encrypted_verifier_hash_input, key1, iv)
+    verifier_hash = hash_func(verifier).digest()
+    expected_hash = _decrypt_aes_cbc(params.encrypted_verifier_hash_value, key2, iv)
+
+    return expected_hash[:len(verifier_hash)] == verifier_hash
+
+def verify_agile(
+    password: str,
+    salt: bytes,
+    spin_count: int,
+    encrypted_verifier_hash_input: bytes,
+    encrypted_verifier_hash_value: bytes,
+    key_bits: int,
+    hash_algorithm: str = "SHA512"
+) -> bool:
+    """
+    Checks a password against an ECMA-376 Agile Encryption password verifier.
+    This does the same work as OOXMLFile.load_key(verify_password=True) without parsing the file,
+    as a batch of one (see verify_agile_batch).
+
+    :param password: The password to check.
+    :param salt: The password key encryptor salt.
+    :param spin_count: The number of times the password hash is iterated.
+    :param encrypted_verifier_hash_input: The encrypted random verifier.
+    :param encrypted_verifier_hash_value: The encrypted hash of the random verifier.
+    :param key_bits: The size of the AES key in bits.
+    :param hash_algorithm: The hash algorithm named in the EncryptionInfo stream.
+    :return: True if the password is correct.
+    """
+    params = AgileParams(
+        salt, spin_count, encrypted_verifier_hash_input, encrypted_verifier_hash_value,
+        key_bits, hash_algorithm
+    )
+    return verify_agile_batch([password.encode("utf-16-le")], params) is not None
+
+def load_cuda_verifiers() -> dict:
+    """
+    Compiles the CUDA versions of the Agile password check (agile_spin.cu) with CuPy.
+    CuPy is only needed when the GPU is used, so it is imported here rather than at the top.
+
+    The kernels run the whole check, the spin loop as well as the verifier, so only the
+    initial hashes go to the GPU and only a match flag per password comes back. Both are
+    staged in page-locked (pinned) host memory, which the GPU copies to and from directly
+    instead of through a temporary pinned buffer of the driver's own. The buffers are kept
+    between launches since every full batch is the same size.
+
+    :return: A dict from hash algorithm name to a function that takes the joined initial
+        hashes and the Agile verifier parameters and returns the position of the correct
+        password, or None if none of the passwords are correct.
+    """
+    import cupy
+    import numpy
+
+    with open(CUDA_SOURCE_PATH, mode='r', encoding='utf-8') as file:
+        source = file.read()
+
+    threads_per_block = 256
+    stream = cupy.cuda.Stream(non_blocking=True)
+    pinned_buffers = {}
+
+    def pinned(name: str, size: int):
+        """
+        Returns a pinned host buffer of at least size bytes, reusing the last one if it fits.
+        """
+        buffer = pinned_buffers.get(name)
+        if buffer is None or buffer.size < size:
+            memory = cupy.cuda.alloc_pinned_memory(size)
+            buffer = numpy.frombuffer(memory, dtype=numpy.uint8, count=size)
+            pinned_buffers[name] = buffer
+        return buffer[:size]
+
+    def make_verify(kernel_name: str, digest_size: int):
+        kernel = cupy.RawKernel(source, kernel_name)
+        # CuPy compiles on the first launch otherwise, and a compile error belongs here
+        kernel.compile()
+
+        def verify_cuda(h0s: bytes, params: AgileParams) -> Optional[int]:
+            count = len(h0s) // digest_size
+            host_h0s = pinned("h0s", len(h0s))
+            host_h0s[:] = numpy.frombuffer(h0s, dtype=numpy.uint8)
+            host_matches = pinned("matches", count)
+
+            # The IV, the encrypted verifier input and the encrypted verifier hash cut to the
+            # digest size, in the layout agile_spin.cu expects
+            verifier = (
+                _resize(params.salt, 16, b"\x36")
+                + params.encrypted_verifier_hash_input
+                + params.encrypted_verifier_hash_value[:digest_size]
+            )
+
+            with stream:
+                device_h0s = cupy.empty(len(h0s), dtype=cupy.uint8)
+                device_h0s.set(host_h0s, stream=stream)
+                device_verifier = cupy.asarray(numpy.frombuffer(verifier, dtype=numpy.uint8))
+                device_matches = cupy.empty(count, dtype=cupy.uint8)
+                blocks = (count + threads_per_block - 1) // threads_per_block
+                kernel(
+                    (blocks,),
+                    (threads_per_block,),
+                    (
+                        device_h0s,
+                        device_matches,
+                        numpy.uint32(params.spin_count),
+                        numpy.uint32(count),
+                        device_verifier,
+                        numpy.uint32(params.key_bits // 8),
+                    )
+                )
+                device_matches.get(stream=stream, out=host_matches)
+            stream.synchronize()
+
+            positions = numpy.flatnonzero(host_matches)
+            return int(positions[0]) if len(positions) else None
+
+        return verify_cuda
+
+    return {
+        "SHA256": make_verify("verify_sha256", 32),
+        "SHA512": make_verify("verify_sha512", 64),
+    }
+
+def cuda_can_verify(params) -> bool:
+    """
+    Checks that the CUDA password check covers a file. It handles the Agile files Office
+    writes: SHA-512 or SHA-256, a 128, 192 or 256-bit AES key and a 16-byte verifier.
+
+    :param params: The Agile or Standard verifier parameters of the file.
+    :return: True if the file's passwords can be checked on the GPU.
+    """
+    if not isinstance(params, AgileParams) or params.hash_algorithm not in CUDA_HASH_ALGORITHMS:
+        return False
+
+    digest_size = HASH_ALGORITHMS[params.hash_algorithm]().digest_size
+    return (
+        params.key_bits in (128, 192, 256)
+        and len(params.encrypted_verifier_hash_input) == 16
+        and len(params.encrypted_verifier_hash_value) >= digest_size
+    )
+
+def _probe_cuda() -> Tuple[Optional[str], int]:
+    """
+    Finds a CUDA device and compiles the password checks once, to learn whether the GPU can
+    be used at all before the worker pool depends on it.
+
+    :return: A tuple of the error that stopped CUDA from starting, or None if it works, and the
+        number of threads the GPU can keep resident at once.
+    """
+    try:
+        import cupy
+
+        if cupy.cuda.runtime.getDeviceCount() == 0:
+            return "no CUDA device found", 0
+        load_cuda_verifiers()
+        attributes = cupy.cuda.Device().attributes
+    except Exception as e:
+        return str(e) or type(e).__name__, 0
+    return None, attributes["MultiProcessorCount"] * attributes["MaxThreadsPerMultiProcessor"]
+
+def cuda_chunk_size() -> Optional[int]:
+    """
+    Checks that the GPU password checks can run and sizes the batches for the GPU. The check
+    is done in a short-lived process of its own, since a process that has initialized CUDA
+    cannot pass it on to the workers it forks.
+
+    A batch has one password for every thread the GPU can keep resident at once, so every
+    multiprocessor is busy for the whole launch. A larger batch would not run any faster, and would only
+    widen the range of passwords that is checked again after an interruption.
+
+    :return: The number of passwords per kernel launch, or None if the GPU cannot be used.
+    """
+    with multiprocessing.Pool(1) as pool:
+        error, threads = pool.apply(_probe_cuda)
+
+    if error is not None:
+        print(f"CUDA could not be started ({error}), so the CPU is used instead")
+        return None
+    return threads
+
+def _initial_hashes(salt: bytes, passwords: List[bytes], hash_func) -> List[bytes]:
+    """
+    Computes H0 = H(salt + password) for a batch of passwords. The salt is hashed once and the
+    primed hasher is copied for each password instead of hashing the salt again every time.
+
+    :param salt: The salt from the EncryptionInfo stream.
+    :param passwords: The passwords to hash, encoded as UTF-16LE.
+    :param hash_func: The hashlib constructor of the hash algorithm.
+    :return: The initial hash of each password.
+    """
+    salted = hash_func(salt)
+    initial_hashes = []
+    for encoded in passwords:
+        hasher = salted.copy()
+        hasher.update(encoded)
+        initial_hashes.append(hasher.digest())
+    return initial_hashes
+
+def verify_agile_batch(
+    passwords: List[bytes],
+    params: AgileParams,
+    cuda_verifiers: Optional[dict] = None
+) -> Optional[int]:
+    """
+    Checks a batch of passwords against an ECMA-376 Agile Encryption password verifier.
+    With the agile_verify C extension, the hash chains of the whole batch are computed in a
+    single call. On the GPU, the whole check of the batch is a single kernel launch.
+
+    :param passwords: The passwords to check, encoded as UTF-16LE (see iter_segment_utf16).
+    :param params: The Agile verifier parameters.
+    :param cuda_verifiers: The GPU password checks to use instead (see load_cuda_verifiers).
+    :return: The position of the correct password in the batch, or None if none of the
+        passwords are correct.
     """
-    Attempts to open a password-protected Excel file using a list of passwords.
+    hash_func = HASH_ALGORITHMS.get(params.hash_algorithm, hashlib.sha1)
+    initial_hashes = _initial_hashes(params.salt, passwords, hash_func)
+
+    cuda_verify = (cuda_verifiers or {}).get(params.hash_algorithm)
+    if cuda_verify is not None:
+        return cuda_verify(b"".join(initial_hashes), params)
+
+    final_hashes = _spin_batch(initial_hashes, params.spin_count, params.hash_algorithm)
+
+    for position, h in enumerate(final_hashes):
+        if _check_agile_hash(h, params):
+            return position
+    return None
+
+def get_standard_params(officefile: OOXMLFile) -> Optional[StandardParams]:
+    """
+    Extracts the password verifier of a Standard Encryption file, like get_agile_params.
+
+    :param officefile: The parsed encrypted file.
+    :return: The verifier parameters, or None if the file does not use Standard Encryption.
+    """
+    if getattr(officefile, "type", None) != "standard":
+        return None
+
+    info = officefile.info
+    return StandardParams(
+        salt=info["verifier"]["salt"],
+        key_bits=info["header"]["keySize"],
+        encrypted_verifier=info["verifier"]["encryptedVerifier"],
+        encrypted_verifier_hash=info["verifier"]["encryptedVerifierHash"],
+    )
+
+def _check_standard_hash(h: bytes, params: StandardParams) -> bool:
+    """
+    Finishes a Standard password check once the SHA-1 password hash has been iterated:
+    derives the AES key and checks that the decrypted verifier matches its decrypted hash.
+
+    AES-ECB decrypts each block on its own, so the first 16 bytes of the verifier hash are
+    compared before the second block is decrypted. Almost every wrong password is rejected
+    there, and the last 4 bytes of the SHA-1 hash are only checked when those 16 bytes match.
+
+    :param h: The final iterated password hash.
+    :param params: The Standard verifier parameters.
+    :return: True if the password the hash came from is correct.
+    """
+    h_final = hashlib.sha1(h + b"\x00\x00\x00\x00").digest()
+    x1 = hashlib.sha1(bytes(b ^ 0x36 for b in h_final) + b"\x36" * 44).digest()
+    x2 = hashlib.sha1(bytes(b ^ 0x5C for b in h_final) + b"\x5c" * 44).digest()
+    key = (x1 + x2)[:params.key_bits // 8]
+
+    decryptor = Cipher(algorithms.AES(key), modes.ECB()).decryptor()
+    verifier_hash = hashlib.sha1(decryptor.update(params.encrypted_verifier[:16])).digest()
+    if decryptor.update(params.encrypted_verifier_hash[:16]) != verifier_hash[:16]:
+        return False
+    return decryptor.update(params.encrypted_verifier_hash[16:32])[:4] == verifier_hash[16:]
+
+def verify_standard_batch(passwords: List[bytes], params: StandardParams) -> Optional[int]:
+    """
+    Checks a batch of passwords against an ECMA-376 Standard Encryption password verifier.
+
+    :param passwords: The passwords to check, encoded as UTF-16LE (see iter_segment_utf16).
+    :param params: The Standard verifier parameters.
+    :return: The position of the correct password in the batch, or None if none of the
+        passwords are correct.
+    """
+    initial_hashes = _initial_hashes(params.salt, passwords, hashlib.sha1)
+    final_hashes = _spin_batch(initial_hashes, STANDARD_SPIN_COUNT, "SHA1")
+    for position, h in enumerate(final_hashes):
+        if _check_standard_hash(h, params):
+            return position
+    return None
+
+class Task(NamedTuple):
+    """
+    A range of passwords from one segment of the keyspace, sent to a worker process.
+    The worker generates the passwords itself, so only the range is sent.
+    """
+    seq: int
+    segment: Segment
+    start: int
+    stop: int
+
+    @property
+    def key(self) -> str:
+        """
+        The key of the task's segment in the progress file.
+        """
+        return self.segment.key
+
+def _make_tasks(
+    keyspace: List[Segment],
+    progress: dict,
+    chunk_size: int
+) -> Generator[Task, None, None]:
+    """
+    Splits the keyspace into numbered tasks of at most chunk_size passwords, starting each
+    segment where the previous run left off and skipping the ranges it already checked.
+
+    :param keyspace: The segments to check.
+    :param progress: The progress of earlier runs (see load_progress).
+    :param chunk_size: The maximum number of passwords in each task.
+    :return: A generator yielding each task.
+    """
+    seq = 0
+    for segment in keyspace:
+        key = segment.key
+        start = max(progress["next"].get(key, 0), segment.start)
+        end = segment.end
+        # The end of the segment is added as an empty range so the last gap is checked too
+        done_ranges = sorted(progress["done"].get(key, [])) + [[end, end]]
+        for done_start, done_stop in done_ranges:
+            for chunk_start in range(start, min(done_start, end), chunk_size):
+                chunk_stop = min(chunk_start + chunk_size, done_start, end)
+                yield Task(seq, segment, chunk_start, chunk_stop)
+                seq += 1
+            start = max(start, done_stop)
+
+def _init_worker(params, use_gpu: bool = False):
+    """
+    Initializer for the worker processes. CTRL + C is handled by the main process, which
+    terminates the pool, so the workers ignore it instead of each printing a traceback.
+
+    :param params: The Agile or Standard verifier parameters of the encrypted file.
+    :param use_gpu: Whether this worker checks the passwords on the GPU.
+    """
+    global _worker_params, _worker_cuda_verifiers
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    _worker_params = params
+
+    # CUDA must be initialized in the process that uses it, not inherited from the parent.
+    # An initializer that raises is restarted by the pool forever, so a failure here leaves the
+    # password check on the CPU instead
+    if use_gpu:
+        try:
+            _worker_cuda_verifiers = load_cuda_verifiers()
+        except Exception as e:
+            print(f"CUDA could not be started ({e}), so the CPU is used instead")
+
+def _verify_batch(task: Task) -> Tuple[Task, Optional[int]]:
+    """
+    Generates and checks the passwords of a task against the cached verifier parameters.
+    This runs inside a worker process, so password generation is spread across the workers
+    along with the hashing.
+
+    :param task: The range of passwords to check.
+    :return: A tuple of the task and the index of the correct password in its segment, if it
+        was found.
+    """
+    passwords = list(iter_segment_utf16(task.segment, task.start, task.stop))
+    if isinstance(_worker_params, AgileParams):
+        position = verify_agile_batch(passwords, _worker_params, _worker_cuda_verifiers)
+    else:
+        position = verify_standard_batch(passwords, _worker_params)
+    return task, None if position is None else task.start + position
+
+def test_passwords(
+    excel_file,
+    keyspace: List[Segment],
+    use_gpu: bool = False,
+    shard: Optional[Tuple[int, int]] = None
+):
+    """
+    Attempts to open a password-protected Excel file using every password in the keyspace.
+    The passwords are checked in parallel by a pool of worker processes, one per CPU core.
+    When use_gpu is set and the file's passwords can be checked on a working GPU, GPU_PROCESSES
+    worker processes take turns sending large batches to the GPU instead.
+
+    Progress is saved as the index of the first unchecked password of each segment, so a
+    later run picks up where this one stopped without having to skip passwords one by one.
 
     :param excel_file: Path to the Excel file.
-    :param password_list: A list of passwords to test.
+    :param keyspace: The segments of passwords to test (see build_keyspace).
+    :param use_gpu: Whether to check SHA-512/SHA-256 Agile passwords on the GPU with CuPy.
+    :param shard: The shard and number of shards the keyspace was cut to, if any; its
+        progress is saved separately.
     """
 
-    # Get the list of passwords already checked; this can save time by not checking passwords again
-    checked_passwords = get_checked_passwords(excel_file)
+    # Get the progress of earlier runs; this can save time by not checking passwords again
+    progress = load_progress(excel_file, shard)
+    next_index = progress["next"]
+    # Ranges that earlier runs finished ahead of next_index
+    done_ahead = progress["done"]
 
     file_name = os.path.basename(excel_file)
-    checked_file_path = os.path.join(OUTPUT_FOLDER, f"{file_name}.csv")
     # To make sure that we do not miss the correct password, we create a success file
     # that will contain the correct password if found
     success_file_path = os.path.join(OUTPUT_FOLDER, f"{file_name}_success.csv")
 
     num_checked = 0
-    num_skipped = 0
-
-    # li = list(password_list)
-    # length = len(li)
-
+    num_skipped = sum(
+        max(min(next_index.get(segment.key, 0), segment.end) - segment.start, 0)
+        for segment in keyspace
+    )
+    num_skipped += sum(stop - start for ranges in done_ahead.values() for start, stop in ranges)
+
+    # Parse the encryption header once up front so the workers only have to do the hashing
+    with open(excel_file, "rb") as f:
+        officefile = OOXMLFile(f)
+    params = get_agile_params(officefile) or get_standard_params(officefile)
+
+    password = ""
+
+    # Tasks finish out of order, so a segment's progress only moves past a task once every
+    # task before it has finished too
+    next_seq = 0
+    finished = {}
+    last_saved = 0
+
+    def checkpoint():
+        """
+        Saves next_index along with every range that is already checked but not yet covered by
+        it, so that nothing has to be checked twice after an interruption.
+        """
+        done = {}
+        for key, ranges in done_ahead.items():
+            for start, stop in ranges:
+                if stop > next_index.get(key, 0):
+                    done.setdefault(key, []).append([start, stop])
+        for task in finished.values():
+            done.setdefault(task.key, []).append([task.start, task.stop])
+        save_progress(excel_file, {"next": next_index, "done": done}, shard)
+
+    # Only the Agile files that agile_spin.cu covers are checked on the GPU, and only if CUDA
+    # starts; anything else is left to one process per CPU core
+    if use_gpu and not cuda_can_verify(params):
+        print("The GPU only handles Agile files hashed with SHA-512 or SHA-256, so the CPU "
+              "is used instead")
+        use_gpu = False
+    gpu_chunk_size = cuda_chunk_size() if use_gpu else None
+    use_gpu = gpu_chunk_size is not None
+
+    if use_gpu:
+        processes = GPU_PROCESSES
+        chunk_size = gpu_chunk_size
+        # The GPU processes already cover each other's wait between kernels, so a queued task
+        # would only widen the range that an interruption loses
+        tasks_per_process = 1
+    else:
+        processes = os.cpu_count()
+        chunk_size = CHUNK_SIZE
+        tasks_per_process = TASKS_PER_PROCESS
 
     # Used to determine how long it takes to check all of the passwords
     start_time = time.perf_counter()
 
-    # print(f"Total passwords to check: {length}")
-
-    # This opens both the Excel file we will be attempting to find the password for
-    # and the file we will be writing the checked passwords to
-    with open(excel_file, "rb") as f, \
-        open(checked_file_path, mode='a', newline='', encoding='utf-8') as checked_file, \
-        open(success_file_path, mode='a', newline='', encoding='utf-8') as success_file:
-        file = OOXMLFile(f)
-
-        # print(f"Checking {length} passwords...")
+    # The status line is rewritten in place at most once per STATUS_INTERVAL, on stderr so it
+    # stays out of redirected output. A log file would get every update on one growing line,
+    # so it is only shown on a terminal.
+    show_status = sys.stderr.isatty()
+    last_status = start_time
+    status_shown = False
+
+    def end_status():
+        """
+        Moves past the status line so that the next message starts on a new line.
+        """
+        nonlocal status_shown
+        if status_shown:
+            sys.stderr.write("\n")
+            status_shown = False
+
+    with open(success_file_path, mode='a', newline='', encoding='utf-8') as success_file, \
+        multiprocessing.Pool(
+            processes,
+            initializer=_init_worker,
+            initargs=(params, use_gpu)
+        ) as pool:
+
+        # Pool.imap_unordered would pull every task from the generator as fast as it can, so
+        # only a few tasks per worker are submitted at a time and each result submits the next
+        tasks = _make_tasks(keyspace, {"next": dict(next_index), "done": done_ahead}, chunk_size)
+        results = queue.Queue()
+
+        def submit_next() -> bool:
+            """
+            Submits the next task to the pool, if there is one left.
+            """
+            task = next(tasks, None)
+            if task is None:
+                return False
+            pool.apply_async(
+                _verify_batch, (task,), callback=results.put, error_callback=results.put
+            )
+            return True
 
-        for password in password_list:
-
-            # print('Current password:', password)
-
-            try:
-
-                # Skip the password if it has already been checked
-                if password in checked_passwords:
-                    # print('Skipping already checked password:', password)
-                    num_skipped += 1
-                    continue
-
-                # Print the current password being checked
-                # print(f"Checking password: '{password}'")
-
-                # This will attempt to verify the password
-                # https://msoffcrypto-tool.readthedocs.io/en/latest/index.html#id1
-                num_checked += 1
-                file.load_key(password=password, verify_password=True)
-
-                # If the password is correct, write it to the success file and print the result
-                success_file.write(f"{password}\n")
-
-                print_completion_message(start_time, password, num_checked, num_skipped)
-                return
-
-            except msoffcrypto.exceptions.DecryptionError:
-                # Even printing the error message can be a security risk and slow things down, so
-                # do nothing
-                # print(f"DecryptionError: Failed to verify password '{password}'. {e}")
-                pass
-            except KeyboardInterrupt:
-                print("KeyboardInterrupt: Stopping password check because CTRL + C was pressed.")
-                # This break is required to stop the program! Otherwise, it will continue to
-                # check the next password
-                break
-            except Exception as e:
-                print(f"An unknown error occurred: {e}")
-
-            # Write the password to the checked file
-            checked_file.write(f"{password}\n")
-
-    # Print the completion message if no password was found
-    print_completion_message(start_time, "", num_checked, num_skipped)
+        try:
+            in_flight = 0
+            while in_flight < processes * tasks_per_process and submit_next():
+                in_flight += 1
+
+            while in_flight:
+                result = results.get()
+                in_flight -= 1
+                if isinstance(result, BaseException):
+                    raise result
+                if submit_next():
+                    in_flight += 1
+
+                task, found = result
+                if found is not None:
+                    # If the password is correct, write it to the success file right away.
+                    # The passwords of the task after it were never checked.
+                    password = next(iter_segment(task.segment, found, found + 1))
+                    success_file.write(f"{password}\n")
+                    num_checked += found + 1 - task.start
+                    break
+
+                num_checked += task.stop - task.start
+                finished[task.seq] = task
+                while next_seq in finished:
+                    done = finished.pop(next_seq)
+                    next_index[done.key] = done.stop
+                    next_seq += 1
+
+                if num_checked - last_saved >= CHECKPOINT_INTERVAL:
+                    checkpoint()
+                    last_saved = num_checked
+
+                now = time.perf_counter()
+                if show_status and now - last_status >= STATUS_INTERVAL:
+                    rate = num_checked / (now - start_time)
+                    # Clear to the end of the line in case the last update was longer
+                    sys.stderr.write(
+                        f"\rChecked {num_checked} passwords ({rate:.0f} pwds/sec)\x1b[K"
+                    )
+                    sys.stderr.flush()
+                    last_status = now
+                    status_shown = True
+
+        except KeyboardInterrupt:
+            end_status()
+            print("KeyboardInterrupt: Stopping password check because CTRL + C was pressed.")
+        finally:
+            # Progress is saved first since it only needs the state of this process
+            checkpoint()
+            # Stop the workers from checking any more passwords
+            pool.terminate()
+            end_status()
+
+    print_completion_message(start_time, password, num_checked, num_skipped)
 
 def main():
     """
@@ -373,6 +1352,15 @@ def main():
     print("Prefixes:", prefixes)
     print("Suffixes:", suffixes)
     print("Max Length:", max_length)
+    if args.gpu:
+        if importlib.util.find_spec("cupy") is None:
+            print("The --gpu option requires CuPy: https://docs.cupy.dev/en/stable/install.html")
+            sys.exit(1)
+        print("Password check: CUDA (agile_spin.cu) for SHA-512/SHA-256")
+    elif openssl_info is not None:
+        print("Spin loop: agile_verify C extension,", openssl_info())
+    else:
+        print("Spin loop: Python (build agile_verify for better performance)")
 
     # 1. Test if the file is encrypted
     if not file_is_encrypted(office_file):
@@ -386,12 +1374,16 @@ def main():
     # 2. Now that we have confirmed the file is encrypted, we can generate passwords
     # By specifying only prefixes, we can generate all passwords with the given prefixes
     # Therefore, to generate all passwords starting with a letter, add the letter as a prefix
-    all_passwords = generate_passwords(prefixes, suffixes, max_length=max_length)
+    # The passwords themselves are generated as they are checked
+    keyspace = build_keyspace(prefixes, suffixes, max_length=max_length)
 
-    print("Passwords have been generated")
+    if args.shard is not None:
+        keyspace = shard_keyspace(keyspace, *args.shard)
+        print(f"Shard: {args.shard[0]} of {args.shard[1]} (counting from 0)")
+    print(f"Passwords to check: {sum(segment.size for segment in keyspace)}")
 
     # 3. Loop through the password list and test all of the passwords until we find the right one
-    test_passwords(excel_file=office_file, password_list=all_passwords)
+    test_passwords(excel_file=office_file, keyspace=keyspace, use_gpu=args.gpu, shard=args.shard)
 
 # Example usage
 if __name__ == "__main__":
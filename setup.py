@@ -0,0 +1,20 @@
+"""
+Builds the optional agile_verify C extension next to main.py:
+
+    python setup.py build_ext --inplace
+
+main.py falls back to a pure Python hash loop when the extension is not built.
+"""
+from setuptools import Extension, setup
+
+setup(
+    name="agile_verify",
+    ext_modules=[
+        Extension(
+            "agile_verify",
+            sources=["agile_verify.c"],
+            # OpenSSL's libcrypto provides the SHA-512 implementation
+            libraries=["crypto"],
+        )
+    ],
+)